@@ -27,6 +27,7 @@ class WebSocketMQClient {
     this.url = url
     this.id = id || generateUUID().replace(/-/g, '')
     this.pingInterval = 10
+    this.protocolLevel = 4 // 5 enables subscription options (maxRate), brokers without level 5 support misread it
     this.onReceives = {}
     this.ws = null
     this.pingIntervalId = null
@@ -63,11 +64,13 @@ class WebSocketMQClient {
 
   sendConnect() {
     const protocolName = 'MQTT'
-    const protocolLevel = 4
+    const protocolLevel = this.protocolLevel
     const connectFlags = 2  // Clean session
     const keepAlive = 60
+    const properties = (protocolLevel >= 5) ? [0x00] : []
     const clientIdArray = new Uint8Array([this.id.length >> 8, this.id.length & 0xFF].concat(Array.from(this.id).map(c => c.charCodeAt(0))))
-    const connectMessage = new Uint8Array([0x10, 10 + this.id.length, 0x00, protocolName.length, ...protocolName.split('').map(c => c.charCodeAt(0)), protocolLevel, connectFlags, keepAlive >> 8, keepAlive & 0xFF, ...clientIdArray])
+    const remainingLength = 10 + properties.length + clientIdArray.length
+    const connectMessage = new Uint8Array([0x10, ...this.encodeRemainingLength(remainingLength), 0x00, protocolName.length, ...protocolName.split('').map(c => c.charCodeAt(0)), protocolLevel, connectFlags, keepAlive >> 8, keepAlive & 0xFF, ...properties, ...clientIdArray])
     this._send(connectMessage)
   }
 
@@ -129,10 +132,22 @@ class WebSocketMQClient {
     }
   }
 
-  subscribe(topic, onReceive, msgId = 1) {
+  // maxRate: maximum messages per second the broker delivers on this topic, only the latest message is kept in between
+  // (topics carrying video/encoded content are never rate limited, needs protocolLevel 5)
+  subscribe(topic, onReceive, msgId = 1, maxRate = null) {
     this.onReceives[topic] = onReceive
     const topicLength = topic.length
-    const message = new Uint8Array([0x82, 5 + topicLength, msgId >> 8, msgId & 0xFF, topicLength >> 8, topicLength & 0xFF, ...topic.split('').map(c => c.charCodeAt(0)), 0x00])  // QoS
+    let properties = []
+    if (this.protocolLevel >= 5) {
+      if (maxRate !== null) {
+        properties = properties.concat(this.encodeUserProperty('max_rate', String(maxRate)))
+      }
+      properties = [properties.length, ...properties]
+    } else if (maxRate !== null) {
+      console.warn(`maxRate needs protocolLevel 5, ignored for topic: ${topic}`)
+    }
+    const remainingLength = 2 + properties.length + 2 + topicLength + 1
+    const message = new Uint8Array([0x82, ...this.encodeRemainingLength(remainingLength), msgId >> 8, msgId & 0xFF, ...properties, topicLength >> 8, topicLength & 0xFF, ...topic.split('').map(c => c.charCodeAt(0)), 0x00])  // QoS
     this._send(message)
     console.log(`Subscribed to topic: ${topic}`)
   }
@@ -140,7 +155,9 @@ class WebSocketMQClient {
   unsubscribe(topic, msgId = 1) {
     delete this.onReceives[topic]
     const topicLength = topic.length
-    const message = new Uint8Array([0xA2, 4 + topicLength, msgId >> 8, msgId & 0xFF, topicLength >> 8, topicLength & 0xFF, ...topic.split('').map(c => c.charCodeAt(0))])
+    const properties = (this.protocolLevel >= 5) ? [0x00] : []
+    const remainingLength = 2 + properties.length + 2 + topicLength
+    const message = new Uint8Array([0xA2, ...this.encodeRemainingLength(remainingLength), msgId >> 8, msgId & 0xFF, ...properties, topicLength >> 8, topicLength & 0xFF, ...topic.split('').map(c => c.charCodeAt(0))])
     this._send(message)
     console.log(`Unsubscribed from topic: ${topic}`)
   }
@@ -175,6 +192,10 @@ class WebSocketMQClient {
     return encoded
   }
 
+  encodeUserProperty(key, value) {
+    return [38, key.length, ...key.split('').map(c => c.charCodeAt(0)), value.length, ...value.split('').map(c => c.charCodeAt(0))]  // User Property
+  }
+
   sendPing() {
     const pingreqMessage = new Uint8Array([0xC0, 0x00])
     this._send(pingreqMessage)
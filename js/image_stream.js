@@ -14,6 +14,25 @@ class ImageStream {
     this.client = new WebSocketMQClient(url)
     this.stopEvent = false
     this.frameCount = {} // Record the frame count for each topic
+    this.keyframeInterval = 1 // Minimum seconds between keyframes forced by keyframe requests
+    this.keyframeRequests = {} // Key: topic, value: whether a subscriber is waiting for a keyframe
+    this.keyframeTimes = {} // Key: topic, value: time of the last keyframe encoded
+    this.keyframeRequested = {} // Key: topic, value: time this subscriber last requested a keyframe
+  }
+
+  // Control topic on which subscribers ask the publisher of topic for a keyframe
+  keyframeTopic(topic) {
+    return `${topic}/keyframe`
+  }
+
+  // Ask the publisher of topic for a keyframe, at most once per keyframeInterval
+  requestKeyframe(topic) {
+    const now = Date.now() / 1000
+    if (now - (this.keyframeRequested[topic] || 0) < this.keyframeInterval) {
+      return
+    }
+    this.keyframeRequested[topic] = now
+    this.client.publish(this.keyframeTopic(topic), JSON.stringify({ subscriber: this.client.id }), 'application/json')
   }
 
   async onMessage(topic, payload, props) {
@@ -28,6 +47,8 @@ class ImageStream {
       const isKeyframe = !!(new DataView(payload.buffer).getUint8(0))
       if (isKeyframe) {
         this.subscribersReady[topic] = true
+      } else if (!this.subscribersReady[topic]) {
+        this.requestKeyframe(topic)
       }
       if (this.subscribersReady[topic]) {
         const decoder = this.decoders[topic]
@@ -134,9 +155,16 @@ class ImageStream {
     }
 
     // Ensure the first frame of each topic is a keyframe and set keyframe according to gop_size
+    // Force a keyframe for the subscribers that requested one
     const gopSize = metadata.gop_size || 50
-    const isKeyframe = this.frameCount[topic] % gopSize === 0
+    const now = Date.now() / 1000
+    const isRequested = this.keyframeRequests[topic] && now - (this.keyframeTimes[topic] || 0) >= this.keyframeInterval
+    const isKeyframe = this.frameCount[topic] % gopSize === 0 || isRequested
     this.frameCount[topic] = (this.frameCount[topic] + 1) % gopSize // Increment frame count and mod by gopSize
+    if (isKeyframe) {
+      this.keyframeRequests[topic] = false
+      this.keyframeTimes[topic] = now
+    }
 
     await encoder.encode(frame, { keyFrame: isKeyframe })
     frame.close() // Ensure the frame is closed after encoding
@@ -171,6 +199,7 @@ class ImageStream {
       this.onReceives[topic] = onReceive
     }
     this.client.subscribe(topic, (t, p, props) => this.onMessage(t, p, props))
+    this.requestKeyframe(topic)
   }
 
   unsubscribe(topic) {
@@ -178,7 +207,11 @@ class ImageStream {
     this.client.unsubscribe(topic)
   }
 
+  // Subscribers joining later can request a keyframe, so gop_size can be large
   publish(topic, metadata) {
+    if (!this.metadata[topic]) {
+      this.client.subscribe(this.keyframeTopic(topic), () => { this.keyframeRequests[topic] = true })
+    }
     this.metadata[topic] = metadata
     if (this.encoders[topic]) {
       delete this.encoders[topic] // Remove the encoder to ensure it gets re-initialized with new metadata
@@ -11,6 +11,7 @@ class WebSocketMQServer {
     this.port = port
     this.clients = {}
     this.subscribers = {}
+    this.protocolLevels = new Map()  // key: ws, value: protocol level from CONNECT
   }
 
   start() {
@@ -51,12 +52,18 @@ class WebSocketMQServer {
   handleConnect(ws, message) {
     const protocolNameLength = message.readUInt16BE(2)
     const protocolName = message.slice(4, 4 + protocolNameLength).toString()
-    const clientIdLength = message.readUInt16BE(8 + protocolNameLength)
-    const clientId = message.slice(10 + protocolNameLength, 10 + protocolNameLength + clientIdLength).toString()
+    const protocolLevel = message[4 + protocolNameLength]
+    let index = 8 + protocolNameLength
+    if (protocolLevel >= 5) {
+      index += 1 + message[index]  // Skip properties
+    }
+    const clientIdLength = message.readUInt16BE(index)
+    const clientId = message.slice(index + 2, index + 2 + clientIdLength).toString()
 
     this.clients[clientId] = ws
+    this.protocolLevels.set(ws, protocolLevel)
 
-    const connackMessage = Buffer.from([0x20, 0x02, 0x00, 0x00])
+    const connackMessage = (protocolLevel >= 5) ? Buffer.from([0x20, 0x03, 0x00, 0x00, 0x00]) : Buffer.from([0x20, 0x02, 0x00, 0x00])
     ws.send(connackMessage)
     console.log(`Client ${clientId} connected`)
     return clientId
@@ -69,13 +76,14 @@ class WebSocketMQServer {
         delete this.subscribers[topic]
       }
     })
+    this.protocolLevels.delete(this.clients[clientId])
     delete this.clients[clientId]
     console.log(`Client ${clientId} disconnected`)
   }
 
   handleSubscribe(ws, message) {
     const msgId = message.readUInt16BE(2)
-    const payload = message.slice(4)
+    const payload = message.slice(this.variableHeaderEnd(ws, message))
     const topics = this.parseSubscribeTopics(payload)
 
     topics.forEach(([topic, qos]) => {
@@ -91,7 +99,7 @@ class WebSocketMQServer {
 
   handleUnsubscribe(ws, message) {
     const msgId = message.readUInt16BE(2)
-    const payload = message.slice(4)
+    const payload = message.slice(this.variableHeaderEnd(ws, message))
     const topics = this.parseUnsubscribeTopics(payload)
 
     topics.forEach(topic => {
@@ -139,6 +147,18 @@ class WebSocketMQServer {
     console.log('Sent PINGRESP')
   }
 
+  // Index of the SUBSCRIBE/UNSUBSCRIBE payload, skipping the properties of protocol level 5
+  // (subscription options such as max_rate are not supported by this server)
+  variableHeaderEnd(ws, message) {
+    let i = 1
+    while (message[i++] & 128) {}  // Remaining length
+    i += 2  // Message id
+    if ((this.protocolLevels.get(ws) || 4) >= 5) {
+      i += 1 + message[i]
+    }
+    return i
+  }
+
   parseSubscribeTopics(payload) {
     const topics = []
     let i = 0
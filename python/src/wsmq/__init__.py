@@ -1,3 +1,21 @@
-from wsmq.server import WebSocketMQServer
-from wsmq.client import WebSocketMQClient
-from wsmq.image_stream import ImageStream
\ No newline at end of file
+import importlib
+
+# Submodules are imported on first attribute access so that e.g. a plain
+# WebSocketMQClient user does not pay for av, cv2, PIL and numpy.
+_lazy_attrs = {
+    'WebSocketMQServer': 'wsmq.server',
+    'WebSocketMQClient': 'wsmq.client',
+    'ImageStream': 'wsmq.image_stream',
+}
+
+__all__ = list(_lazy_attrs)
+
+def __getattr__(name):
+    if name in _lazy_attrs:
+        value = getattr(importlib.import_module(_lazy_attrs[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module 'wsmq' has no attribute '{name}'")
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
\ No newline at end of file
@@ -12,9 +12,33 @@ class WebSocketMQClient:
         self.id = uuid.uuid4().hex if id is None else id
         self.ws = None
         self.ping_interval = 10
+        self.protocol_level = 4  # 5 enables subscription options (max_rate) and topic aliases, brokers without level 5 support misread it
         self.on_receives = {}
+        self.ready = threading.Event()  # Set once CONNACK is received
+        self.settled = threading.Event()  # Set once CONNACK is received or the connection failed
+        self.pending = []  # Messages sent before CONNACK, flushed on CONNACK (None after a failed attempt or a close: dropped)
+        self.pending_lock = threading.Lock()
+        self.topic_alias_maximum = 100  # Topic aliases the broker may use towards this client, sent in CONNECT
+        self.topic_aliases = {}  # key: alias, value: topic, set by the broker
+        self.publish_aliases = {}  # key: topic, value: alias, set by this client
+        self.publish_alias_maximum = 0  # Topic aliases this client may use, from CONNACK
+        self.publish_lock = threading.Lock()
 
     def connect(self, daemon=False):
+        '''
+        Connect to the broker in a background thread
+        Return an event that is set once the broker acknowledges the connection (CONNACK)
+        Messages sent until then (also before connect) are queued, see also wait_ready
+        '''
+        with self.publish_lock:  # Messages queued until CONNACK must not use the aliases of a previous connection
+            self.topic_aliases = {}
+            self.publish_aliases = {}
+            self.publish_alias_maximum = 0
+        with self.pending_lock:
+            if self.pending is None:
+                self.pending = []
+            self.ready.clear()
+            self.settled.clear()
         self.ws = websocket.WebSocketApp(
             self.url,
             on_open=self.on_open,
@@ -22,7 +46,28 @@ class WebSocketMQClient:
             on_error=self.on_error,
             on_close=self.on_close
         )
-        threading.Thread(target=self.ws.run_forever, daemon=daemon).start()
+        threading.Thread(target=self.run_forever, daemon=daemon).start()
+        return self.ready
+
+    def run_forever(self):
+        self.ws.run_forever()
+        self.stop_connecting()
+
+    def wait_ready(self, timeout=5):
+        '''
+        Wait until the broker acknowledges the connection, the connection fails, or timeout seconds
+        Return whether the connection is ready
+        '''
+        self.settled.wait(timeout)
+        return self.ready.is_set()
+
+    def stop_connecting(self):
+        '''
+        Drop the queued messages, they are not sent when the connection fails
+        '''
+        with self.pending_lock:
+            self.pending = None
+            self.settled.set()
     
     def on_open(self, ws):
         logging.info(f'Connected to MQTT Broker {self.url}, client id: {self.id}')
@@ -31,12 +76,17 @@ class WebSocketMQClient:
     
     def send_connect(self):
         protocol_name = 'MQTT'
-        protocol_level = 4
+        protocol_level = self.protocol_level
         connect_flags = 2  # Clean session
         keep_alive = 60
+        properties = b''
+        if protocol_level >= 5:
+            properties = struct.pack('!BH', 34, self.topic_alias_maximum)  # Topic Alias Maximum
+            properties = struct.pack('!B', len(properties)) + properties
         payload = struct.pack('!H', len(self.id)) + self.id.encode()
-        connect_message = struct.pack('!BBH4sBBH', 0x10, 10 + len(self.id), len(protocol_name), protocol_name.encode(), protocol_level, connect_flags, keep_alive) + payload
-        self._send(connect_message, websocket.ABNF.OPCODE_BINARY)
+        remaining_length = 10 + len(properties) + len(payload)
+        connect_message = struct.pack('!B', 0x10) + self.encode_remaining_length(remaining_length) + struct.pack('!H4sBBH', len(protocol_name), protocol_name.encode(), protocol_level, connect_flags, keep_alive) + properties + payload
+        self._send(connect_message, websocket.ABNF.OPCODE_BINARY, queue=False)
 
     def on_message(self, ws, message):
         data = bytearray(message)
@@ -45,6 +95,24 @@ class WebSocketMQClient:
 
         if msg_type == 2:  # CONNACK
             logging.debug('Received CONNACK')
+            if len(data) > 4:
+                i = 5
+                while i < 5 + data[4]:
+                    prop_id = data[i]
+                    if prop_id == 34:  # Topic Alias Maximum
+                        self.publish_alias_maximum = struct.unpack('!H', data[i+1:i+3])[0]
+                        i += 3
+                    elif prop_id == 38:  # User Property
+                        i += 2 + data[i+1]
+                        i += 1 + data[i]
+                    else:
+                        break
+            with self.pending_lock:
+                for message, opcode in self.pending or []:
+                    self._send(message, opcode, queue=False)
+                self.pending = None
+                self.ready.set()
+                self.settled.set()
         elif msg_type == 3:  # PUBLISH
             i = 1
             multiplier = 1
@@ -64,6 +132,7 @@ class WebSocketMQClient:
             properties_length = data[i]
             i += 1
             props = {}
+            topic_alias = None
             while properties_length > 0:
                 prop_id = data[i]
                 i += 1
@@ -79,7 +148,16 @@ class WebSocketMQClient:
                     props['content_type'] = data[i:i+content_type_length].decode()
                     i += content_type_length
                     properties_length -= content_type_length
+                elif prop_id == 35:  # Topic Alias
+                    topic_alias = struct.unpack('!H', data[i:i+2])[0]
+                    i += 2
+                    properties_length -= 2
             payload = data[i:]
+            if topic_alias is not None:
+                if topic:
+                    self.topic_aliases[topic_alias] = topic
+                else:
+                    topic = self.topic_aliases.get(topic_alias, '')
 
             if 'payload_format_indicator' in props and props['payload_format_indicator'] == 1:
                 payload = payload.decode() # not binary
@@ -91,26 +169,48 @@ class WebSocketMQClient:
 
     def on_error(self, ws, error):
         logging.warning(f'Error: {error}')
+        if not self.ready.is_set():
+            self.stop_connecting()
 
     def on_close(self, ws, close_status_code, close_msg):
+        self.ready.clear()
+        self.stop_connecting()
         logging.info('Connection closed')
 
-    def subscribe(self, topic, on_receive, msg_id=1):
+    def subscribe(self, topic, on_receive, msg_id=1, max_rate=None):
+        '''
+        Subscribe to a topic with a callback function (topic, payload, props)
+        max_rate: maximum messages per second the broker delivers on this topic, only the latest message is kept in between
+        (topics carrying video/encoded content are never rate limited, needs protocol_level 5)
+        '''
         self.on_receives[topic] = on_receive
         topic_length = len(topic)
-        message = struct.pack('!BBH', 0x82, 5 + topic_length, msg_id) + struct.pack('!H', topic_length) + topic.encode() + b'\x00'
+        properties = b''
+        if self.protocol_level >= 5:
+            if max_rate is not None:
+                properties += self.encode_user_property('max_rate', str(max_rate))
+            properties = struct.pack('!B', len(properties)) + properties
+        elif max_rate is not None:
+            logging.warning(f'max_rate needs protocol_level 5, ignored for topic: {topic}')
+        remaining_length = 2 + len(properties) + 2 + topic_length + 1
+        message = struct.pack('!B', 0x82) + self.encode_remaining_length(remaining_length) + struct.pack('!H', msg_id) + properties + struct.pack('!H', topic_length) + topic.encode() + b'\x00'
         self._send(message, websocket.ABNF.OPCODE_BINARY)
         logging.info(f'Subscribed to topic: {topic}')
 
     def unsubscribe(self, topic, msg_id=1):
         del self.on_receives[topic]
         topic_length = len(topic)
-        message = struct.pack('!BBH', 0xA2, 4 + topic_length, msg_id) + struct.pack('!H', topic_length) + topic.encode()
+        properties = b'\x00' if self.protocol_level >= 5 else b''
+        remaining_length = 2 + len(properties) + 2 + topic_length
+        message = struct.pack('!B', 0xA2) + self.encode_remaining_length(remaining_length) + struct.pack('!H', msg_id) + properties + struct.pack('!H', topic_length) + topic.encode()
         self._send(message, websocket.ABNF.OPCODE_BINARY)
         logging.info(f'Unsubscribed from topic: {topic}')
     
     def publish(self, topic, payload, content_type=None):
-        topic_length = len(topic)
+        '''
+        Publish payload (str or bytes) to a topic
+        After the first message on a topic, the topic is sent as a 2-byte alias if the broker accepts topic aliases
+        '''
         if isinstance(payload, str):
             payload = payload.encode()
             is_binary = False
@@ -125,11 +225,21 @@ class WebSocketMQClient:
             properties += struct.pack('!B', 1) + struct.pack('!B', 1)  # Payload Format Indicator
         if content_type is not None:
             properties += struct.pack('!B', 3) + struct.pack('!B', len(content_type)) + content_type.encode()  # Content Type
-        properties_length = len(properties)
-        remaining_length = 2 + topic_length + 1 + properties_length + payload_length
-        remaining_length_bytes = self.encode_remaining_length(remaining_length)
-        message = struct.pack('!B', fixed_header) + remaining_length_bytes + struct.pack('!H', topic_length) + topic.encode() + struct.pack('!B', properties_length) + properties + payload
-        self._send(message, websocket.ABNF.OPCODE_BINARY)
+        with self.publish_lock:  # The message setting an alias must be sent before the ones using it
+            topic_bytes = topic.encode()
+            alias = self.publish_aliases.get(topic)
+            if alias is not None:
+                topic_bytes = b''
+            elif len(self.publish_aliases) < self.publish_alias_maximum:
+                alias = self.publish_aliases[topic] = len(self.publish_aliases) + 1
+            if alias is not None:
+                properties += struct.pack('!BH', 35, alias)  # Topic Alias
+            topic_length = len(topic_bytes)
+            properties_length = len(properties)
+            remaining_length = 2 + topic_length + 1 + properties_length + payload_length
+            remaining_length_bytes = self.encode_remaining_length(remaining_length)
+            message = struct.pack('!B', fixed_header) + remaining_length_bytes + struct.pack('!H', topic_length) + topic_bytes + struct.pack('!B', properties_length) + properties + payload
+            self._send(message, websocket.ABNF.OPCODE_BINARY)
         logging.debug(f'Published message to topic {topic}, is_binary: {is_binary}, content_type: {content_type}')
     
     def encode_remaining_length(self, length):
@@ -145,19 +255,31 @@ class WebSocketMQClient:
                 break
         return encoded
     
+    def encode_user_property(self, key, value):
+        return struct.pack('!BB', 38, len(key)) + key.encode() + struct.pack('!B', len(value)) + value.encode()  # User Property
+
     def send_ping(self, ws):
         while ws.keep_running:
             time.sleep(self.ping_interval)
             pingreq_message = struct.pack('!BB', 0xC0, 0x00)
-            self._send(pingreq_message, websocket.ABNF.OPCODE_BINARY)
+            self._send(pingreq_message, websocket.ABNF.OPCODE_BINARY, queue=False)
             logging.debug('Sent PINGREQ')
     
     def disconnect(self):
         disconnect_message = struct.pack('!BB', 0xE0, 0x00)
-        self._send(disconnect_message, websocket.ABNF.OPCODE_BINARY)
+        self._send(disconnect_message, websocket.ABNF.OPCODE_BINARY, queue=False)
         logging.debug('Sent DISCONNECT')
         self.ws.close()
 
-    def _send(self, message, opcode):
+    def _send(self, message, opcode, queue=True):
+        '''
+        Send a message, or queue it until CONNACK while connecting
+        Messages are dropped when not connected
+        '''
+        if queue:
+            with self.pending_lock:
+                if self.pending is not None:
+                    self.pending.append((message, opcode))
+                    return
         if self.ws and self.ws.sock and self.ws.sock.connected:
             self.ws.send(message, opcode=opcode)
\ No newline at end of file
@@ -1,5 +1,6 @@
 # Note: Only support VP9 now
 import av
+import logging
 import threading
 import queue
 import struct
@@ -9,7 +10,7 @@ import json
 import numpy as np
 from PIL import Image
 import cv2
-from wsmq import WebSocketMQClient
+from wsmq.client import WebSocketMQClient
 
 class ImageStream:
     def __init__(self, url='ws://localhost:6789', buffer_size=1):
@@ -24,6 +25,14 @@ class ImageStream:
         self.decoders = {}  # Decoders for different topics
         self.encoders = {}  # Encoders for different topics
         self.on_receives = {}  # key: topic, value: (callback function (topic, image), image_format)
+        self.keyframe_interval = 1  # Minimum seconds between keyframes forced by keyframe requests
+        self.keyframe_requests = {}  # key: topic, value: whether a subscriber is waiting for a keyframe
+        self.keyframe_times = {}  # key: topic, value: time of the last keyframe encoded
+        self.keyframe_requested = {}  # key: topic, value: time this subscriber last requested a keyframe
+        self.change_threshold = None  # Skip images where no 4x4 area average (0-255) changed by more than this since the last queued image, None to encode every image
+        self.max_skip_interval = 1  # Maximum seconds without queuing an image, for liveness
+        self.last_thumbnails = {}  # key: topic, value: (shape, thumbnail) of the last queued image
+        self.last_image_times = {}  # key: topic, value: time the last image was queued
 
     def on_message(self, topic, payload, props):
         content_type = props.get('content_type', '')
@@ -37,6 +46,8 @@ class ImageStream:
             is_keyframe = bool(struct.unpack('!B', payload[0:1])[0])
             if is_keyframe:
                 self.subscribers_ready[topic].set()
+            elif not self.subscribers_ready.get(topic, threading.Event()).is_set():
+                self.request_keyframe(topic)
             if self.subscribers_ready.get(topic, threading.Event()).is_set():
                 packet = av.packet.Packet(payload[1:])
                 if topic not in self.decoders:
@@ -52,6 +63,25 @@ class ImageStream:
                 except av.AVError as e:
                     print(f"Error decoding packet: {e}")
 
+    def keyframe_topic(self, topic):
+        '''
+        Control topic on which subscribers ask the publisher of topic for a keyframe
+        '''
+        return f'{topic}/keyframe'
+
+    def request_keyframe(self, topic):
+        '''
+        Ask the publisher of topic for a keyframe, at most once per keyframe_interval
+        '''
+        now = time.time()
+        if now - self.keyframe_requested.get(topic, 0) < self.keyframe_interval:
+            return
+        self.keyframe_requested[topic] = now
+        self.client.publish(self.keyframe_topic(topic), json.dumps({'subscriber': self.client.id}), content_type='application/json')
+
+    def on_keyframe_request(self, topic):
+        self.keyframe_requests[topic] = True
+
     def convert_frame(self, frame, image_format):
         '''
         Convert frame to specified image format
@@ -103,9 +133,15 @@ class ImageStream:
         stream = self.encoders[topic]
 
         frame = av.VideoFrame.from_ndarray(frame, format='bgr24')
+        now = time.time()
+        if self.keyframe_requests.get(topic) and now - self.keyframe_times.get(topic, 0) >= self.keyframe_interval:
+            frame.pict_type = av.video.frame.PictureType.I  # Force a keyframe for the subscribers that requested it
         packets = stream.encode(frame)
         keyframes = [pkt for pkt in packets if pkt.is_keyframe]
         if keyframes:
+            # Requests until now are served by this keyframe
+            self.keyframe_requests[topic] = False
+            self.keyframe_times[topic] = now
             # Let the latter peer get the metadata if encounter key frame
             metadata_json = json.dumps(metadata)
             self.client.publish(topic, metadata_json, content_type='application/json')
@@ -124,12 +160,14 @@ class ImageStream:
                         self.client.publish(topic, struct.pack('!B', packet.is_keyframe) + bytes(packet), content_type='video/encoded')
             time.sleep(0.001)
 
-    def start(self):
+    def start(self, timeout=5):
         '''
         Start the client and the frame sending thread
+        Wait until the broker acknowledges the connection (CONNACK), the connection fails, or timeout seconds
         '''
         self.client.connect()
-        time.sleep(0.5)
+        if not self.client.wait_ready(timeout):
+            logging.warning(f'Not connected to {self.url}, frames are dropped unless the connection is still being set up')
         self.thread = threading.Thread(target=self.send_frame, daemon=True)
         self.thread.start()
 
@@ -149,6 +187,7 @@ class ImageStream:
         if on_receive is not None:
             self.on_receives[topic] = (on_receive, image_format)
         self.client.subscribe(topic, lambda t, p, props: self.on_message(t, p, props))
+        self.request_keyframe(topic)
     
     def unsubscribe(self, topic):
         '''
@@ -161,7 +200,10 @@ class ImageStream:
     def publish(self, topic, metadata):
         '''
         Publish metadata for the given topic
+        Subscribers joining later can request a keyframe, so gop_size can be large
         '''
+        if topic not in self.metadata:
+            self.client.subscribe(self.keyframe_topic(topic), lambda t, p, props: self.on_keyframe_request(topic))
         self.metadata[topic] = metadata
         if topic in self.encoders:
             del self.encoders[topic]
@@ -190,12 +232,38 @@ class ImageStream:
             nparr = np.frombuffer(image, np.uint8)
             image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
+        if self.change_threshold is not None:
+            thumbnail = self.thumbnail(image)
+            if self.is_unchanged(topic, image.shape, thumbnail):
+                return  # Subscribers keep presenting the last frame
+            self.last_thumbnails[topic] = (image.shape, thumbnail)
+            self.last_image_times[topic] = time.time()
+
         if topic not in self.queues:
             self.queues[topic] = queue.Queue(maxsize=self.buffer_size)
         if self.queues[topic].full():
             self.queues[topic].get()
         self.queues[topic].put(image)
 
+    def thumbnail(self, image):
+        '''
+        Average each 4x4 area of image, so that small changes are not missed
+        (a movement that keeps the average of every area, e.g. a thin line within one area, is not detected)
+        '''
+        height, width = image.shape[:2]
+        return cv2.resize(image, (max(1, width // 4), max(1, height // 4)), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def is_unchanged(self, topic, shape, thumbnail):
+        '''
+        Whether the image with shape and thumbnail is close enough to the last queued image of topic to be skipped
+        '''
+        if self.keyframe_requests.get(topic) or topic not in self.last_thumbnails:
+            return False
+        last_shape, last_thumbnail = self.last_thumbnails[topic]
+        if last_shape != shape or time.time() - self.last_image_times[topic] >= self.max_skip_interval:
+            return False
+        return np.abs(thumbnail - last_thumbnail).max() <= self.change_threshold
+
     def get_image(self, topic, image_format=None):
         '''
         Get the current frame for the given topic
@@ -3,16 +3,136 @@ import logging
 import struct
 import sys
 import threading
+import uuid
+from websockets.client import connect
 from websockets.server import serve
-from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
+from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError, InvalidMessage, WebSocketException
 import wsmq.config
 
+class ConflatingSender:
+    '''
+    Deliver at most max_rate messages per second of one topic to one subscriber
+    Between deliveries only the latest message is kept
+    '''
+    def __init__(self, websocket, max_rate):
+        self.websocket = websocket
+        self.interval = 1 / max_rate
+        self.last_sent = 0
+        self.latest = None
+        self.handle = None
+        self.task = None  # Send started by flush, awaited before any other send to keep the order
+
+    async def send(self, message):
+        loop = asyncio.get_running_loop()
+        delay = self.last_sent + self.interval - loop.time()
+        if delay <= 0 and self.handle is None:
+            await self.wait_flushed()
+            self.last_sent = loop.time()
+            await self.websocket.send(message)
+        else:
+            self.latest = message
+            if self.handle is None:
+                self.handle = loop.call_later(delay, self.flush)
+
+    def flush(self):
+        self.handle = None
+        message, self.latest = self.latest, None
+        if message is not None:
+            self.last_sent = asyncio.get_running_loop().time()
+            self.task = asyncio.ensure_future(self._send(message))
+
+    async def wait_flushed(self):
+        if self.task is not None:
+            await self.task
+            self.task = None
+
+    async def drain(self):
+        '''
+        Send the pending message (if any) right away, after the one being flushed
+        '''
+        self.cancel()
+        await self.wait_flushed()
+        message, self.latest = self.latest, None
+        if message is not None:
+            self.last_sent = asyncio.get_running_loop().time()
+            await self.websocket.send(message)
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    async def _send(self, message):
+        try:
+            await self.websocket.send(message)
+        except (ConnectionClosedOK, ConnectionClosedError):
+            pass
+
+class BridgeLink:
+    '''
+    Connection to a peer server, used like a subscriber websocket
+    Packets sent within batch_interval seconds are concatenated into WebSocket messages of up to max_batch_size bytes
+    (below the 1 MiB default max_size of the peer, a larger packet is sent alone)
+    '''
+    def __init__(self, websocket, peer_id, batch_interval=0.005, max_batch_size=512 * 1024):
+        self.websocket = websocket
+        self.peer_id = peer_id
+        self.batch_interval = batch_interval
+        self.max_batch_size = max_batch_size
+        self.requested = set()  # Topics subscribed on the peer on behalf of this server
+        self.buffer = []
+        self.event = asyncio.Event()
+        self.task = asyncio.ensure_future(self.write_batches())
+
+    async def send(self, message):
+        self.buffer.append(bytes(message))
+        self.event.set()
+
+    async def write_batches(self):
+        try:
+            while True:
+                await self.event.wait()
+                await asyncio.sleep(self.batch_interval)
+                self.event.clear()
+                packets, self.buffer = self.buffer, []
+                batch = []
+                batch_size = 0
+                for packet in packets:
+                    if batch and batch_size + len(packet) > self.max_batch_size:
+                        await self.websocket.send(b''.join(batch))
+                        batch = []
+                        batch_size = 0
+                    batch.append(packet)
+                    batch_size += len(packet)
+                await self.websocket.send(b''.join(batch))
+        except (ConnectionClosedOK, ConnectionClosedError):
+            pass
+
+    def close(self):
+        self.task.cancel()
+
 class WebSocketMQServer:
-    def __init__(self, host='localhost', port=6789):
+    def __init__(self, host='localhost', port=6789, peers=None, node_id=None):
+        '''
+        peers: URLs of peer servers to bridge with, topics are forwarded only where there is remote interest
+        (links should form a tree, e.g. a hub with its sites, configured on one side of each link)
+        '''
         self.host = host
         self.port = port
+        self.peers = [] if peers is None else peers
+        self.node_id = uuid.uuid4().hex[:8] if node_id is None else node_id
+        self.reconnect_interval = 1
+        self.connack_timeout = 5  # Seconds a peer server has to answer the bridge CONNECT
+        self.topic_alias_maximum = 100  # Topic aliases each client may use, sent in CONNACK
         self.clients = {}
         self.subscribers = {}
+        self.protocol_levels = {}  # key: websocket, value: protocol level from CONNECT
+        self.topic_aliases = {}  # key: websocket, value: {alias: topic} set by the client
+        self.subscriber_aliases = {}  # key: websocket, value: {topic: alias} set by this server, up to the client's maximum
+        self.subscriber_alias_maximums = {}  # key: websocket, value: topic alias maximum from CONNECT
+        self.conflaters = {}  # key: (websocket, topic), value: ConflatingSender
+        self.video_topics = set()  # Topics that carried video/encoded content, exempt from rate limits
+        self.links = []  # BridgeLinks to peer servers
 
     def start(self, daemon=False):
         threading.Thread(target=self.run, daemon=daemon).start()
@@ -24,20 +144,116 @@ class WebSocketMQServer:
 
     async def run_server(self):
         async with serve(self.handle_client, self.host, self.port):
-            logging.info(f'MQTT Server started on ws://{self.host}:{self.port}')
+            logging.info(f'MQTT Server started on ws://{self.host}:{self.port}, node id: {self.node_id}')
+            for url in self.peers:
+                asyncio.ensure_future(self.run_bridge(url))
             await asyncio.Future()
 
+    async def run_bridge(self, url):
+        '''
+        Keep a bridge link to the peer server at url, reconnecting when it drops
+        '''
+        while True:
+            try:
+                async with connect(url) as websocket:
+                    properties = self.encode_user_property('bridge', self.node_id)
+                    client_id = f'bridge-{self.node_id}'
+                    payload = struct.pack('!H', len(client_id)) + client_id.encode()
+                    variable_header = struct.pack('!H4sBBHB', 4, b'MQTT', 5, 2, 60, len(properties)) + properties
+                    await websocket.send(struct.pack('!B', 0x10) + self.encode_remaining_length(len(variable_header) + len(payload)) + variable_header + payload)
+                    connack = await asyncio.wait_for(websocket.recv(), self.connack_timeout)
+                    if not isinstance(connack, bytes) or len(connack) < 5 or connack[0] != 0x20:
+                        raise InvalidMessage('expected a protocol level 5 CONNACK')
+                    props, index = self.parse_properties(connack, 4)
+                    peer_id = props.get('user_properties', {}).get('bridge', url)
+                    link = await self.add_link(websocket, peer_id)
+                    logging.info(f'Bridged to {url}, node id: {peer_id}')
+                    try:
+                        async for message in websocket:
+                            await self.handle_link_message(link, message)
+                    finally:
+                        await self.remove_link(link)
+            except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+                logging.warning(f'Bridge to {url} failed: {e!r}')
+            except Exception:
+                logging.exception(f'Bridge to {url} failed')
+            await asyncio.sleep(self.reconnect_interval)
+
+    async def add_link(self, websocket, peer_id):
+        link = BridgeLink(websocket, peer_id)
+        self.protocol_levels[link] = 5
+        self.links.append(link)
+        for topic in list(self.subscribers):
+            await self.update_interest(topic)
+        return link
+
+    async def remove_link(self, link):
+        if link not in self.links:
+            return
+        link.close()
+        self.links.remove(link)
+        self.protocol_levels.pop(link, None)
+        for topic, subscribers in list(self.subscribers.items()):
+            if link in subscribers:
+                subscribers.remove(link)
+                await self.update_interest(topic)
+        logging.info(f'Bridge to node {link.peer_id} closed')
+
+    async def handle_link_message(self, link, message):
+        '''
+        Handle a batch of packets received from a peer server
+        '''
+        data = bytes(message)
+        index = 0
+        while index < len(data):
+            start = index
+            remaining_length, index = self.decode_remaining_length(data, index + 1)
+            packet = data[start:index+remaining_length]
+            index += remaining_length
+            msg_type = packet[0] >> 4
+            if msg_type == 3:  # PUBLISH
+                await self.handle_publish(memoryview(data)[start:index], link)  # Without copying the payload
+            elif msg_type == 8:  # SUBSCRIBE
+                await self.handle_subscribe(link, packet)
+            elif msg_type == 10:  # UNSUBSCRIBE
+                await self.handle_unsubscribe(link, packet)
+
+    async def update_interest(self, topic):
+        '''
+        Subscribe to (or unsubscribe from) topic on each peer depending on whether anyone else here wants it
+        '''
+        for link in self.links:
+            wanted = any(subscriber is not link for subscriber in self.subscribers.get(topic, []))
+            if wanted == (topic in link.requested):
+                continue
+            if wanted:
+                link.requested.add(topic)
+                packet_type, options = 0x82, b'\x00'
+            else:
+                link.requested.discard(topic)
+                packet_type, options = 0xA2, b''
+            variable_header = struct.pack('!HB', 1, 0) + struct.pack('!H', len(topic.encode())) + topic.encode() + options
+            await link.send(struct.pack('!B', packet_type) + self.encode_remaining_length(len(variable_header)) + variable_header)
+
     async def handle_client(self, websocket, path):
         client_id = None
+        link = None
         try:
             async for message in websocket:
+                if link is not None:
+                    await self.handle_link_message(link, message)
+                    continue
+
                 fixed_header_byte = message[0]
                 msg_type = fixed_header_byte >> 4
 
                 if msg_type == 1:  # CONNECT
-                    client_id = await self.handle_connect(websocket, message)
+                    client_id, peer_id = await self.handle_connect(websocket, message)
+                    if peer_id is not None:
+                        link = await self.add_link(websocket, peer_id)
+                        logging.info(f'Bridged from node {peer_id}')
                 elif msg_type == 3:  # PUBLISH
-                    await self.handle_publish(message)
+                    await self.handle_publish(message, websocket)
                 elif msg_type == 8:  # SUBSCRIBE
                     await self.handle_subscribe(websocket, message)
                 elif msg_type == 10:  # UNSUBSCRIBE
@@ -54,57 +270,128 @@ class WebSocketMQServer:
             if client_id:
                 await self.handle_disconnect(client_id)
         finally:
+            if link:
+                await self.remove_link(link)
             if client_id:
                 await self.handle_disconnect(client_id)
     
     async def handle_connect(self, websocket, message):
-        protocol_name_length = struct.unpack('!H', message[2:4])[0]
-        protocol_name = message[4:4+protocol_name_length].decode()
-        protocol_level = message[4+protocol_name_length]
-        connect_flags = message[5+protocol_name_length]
-        keep_alive = struct.unpack('!H', message[6+protocol_name_length:8+protocol_name_length])[0]
-        payload = message[8+protocol_name_length:]
+        '''
+        Return the client id, and the node id of the peer server if the client is a bridge (otherwise None)
+        '''
+        remaining_length, index = self.decode_remaining_length(message, 1)
+        protocol_name_length = struct.unpack('!H', message[index:index+2])[0]
+        index += 2
+        protocol_name = message[index:index+protocol_name_length].decode()
+        index += protocol_name_length
+        protocol_level = message[index]
+        connect_flags = message[index+1]
+        keep_alive = struct.unpack('!H', message[index+2:index+4])[0]
+        index += 4
+        props = {}
+        if protocol_level >= 5:
+            props, index = self.parse_properties(message, index)
+        payload = message[index:]
         client_id_length = struct.unpack('!H', payload[0:2])[0]
         client_id = payload[2:2+client_id_length].decode()
+        peer_id = props.get('user_properties', {}).get('bridge')
 
         self.clients[client_id] = websocket
+        self.protocol_levels[websocket] = protocol_level
+        self.topic_aliases[websocket] = {}
+        self.subscriber_aliases[websocket] = {}
+        self.subscriber_alias_maximums[websocket] = props.get('topic_alias_maximum', 0)
 
-        connack_message = struct.pack('!BB', 0x20, 0x02) + struct.pack('!BB', 0x00, 0x00)
+        if protocol_level >= 5:
+            properties = struct.pack('!BH', 34, self.topic_alias_maximum)  # Topic Alias Maximum
+            if peer_id is not None:
+                properties += self.encode_user_property('bridge', self.node_id)
+            connack_message = struct.pack('!BB', 0x20, 0x03 + len(properties)) + struct.pack('!BBB', 0x00, 0x00, len(properties)) + properties
+        else:
+            connack_message = struct.pack('!BB', 0x20, 0x02) + struct.pack('!BB', 0x00, 0x00)
         await websocket.send(connack_message)
         logging.info(f'Client {client_id} connected')
-        return client_id
+        return client_id, peer_id
 
     async def handle_disconnect(self, client_id):
-        for topic, subscribers in self.subscribers.items():
+        for topic, subscribers in list(self.subscribers.items()):
             if client_id in self.clients and any(subscriber == self.clients[client_id] for subscriber in subscribers):
                 self.subscribers[topic] = [subscriber for subscriber in subscribers if subscriber != self.clients[client_id]]
+                await self.update_interest(topic)
         if client_id in self.clients:
+            websocket = self.clients[client_id]
+            for key in [key for key in self.conflaters if key[0] == websocket]:
+                self.conflaters.pop(key).cancel()
+            self.protocol_levels.pop(websocket, None)
+            self.topic_aliases.pop(websocket, None)
+            self.subscriber_aliases.pop(websocket, None)
+            self.subscriber_alias_maximums.pop(websocket, None)
             del self.clients[client_id]
             logging.info(f'Client {client_id} disconnected')
     
     async def handle_subscribe(self, websocket, message):
-        msg_id, = struct.unpack("!H", message[2:4])
-        payload = message[4:]
+        remaining_length, index = self.decode_remaining_length(message, 1)
+        msg_id, = struct.unpack("!H", message[index:index+2])
+        index += 2
+        props = {}
+        is_v5 = self.protocol_levels.get(websocket, 4) >= 5
+        if is_v5:
+            props, index = self.parse_properties(message, index)
+        payload = message[index:]
         topics = self.parse_subscribe_topics(payload)
+        try:
+            max_rate = float(props.get('user_properties', {}).get('max_rate', 0))
+        except ValueError:
+            logging.warning(f"Invalid max_rate: {props['user_properties']['max_rate']}, ignored")
+            max_rate = 0
         for topic, qos in topics:
             if topic not in self.subscribers:
                 self.subscribers[topic] = []
-            self.subscribers[topic].append(websocket)
-        await websocket.send(struct.pack('!BBH', 0x90, 3, msg_id) + b'\x00')
+            if websocket not in self.subscribers[topic]:
+                self.subscribers[topic].append(websocket)
+            conflater = self.conflaters.pop((websocket, topic), None)
+            if conflater is not None:
+                conflater.cancel()
+            if max_rate > 0:
+                self.conflaters[(websocket, topic)] = ConflatingSender(websocket, max_rate)
+                logging.debug(f'Limit topic {topic} to {max_rate} messages per second for subscriber')
+            await self.update_interest(topic)
+        if is_v5:
+            await websocket.send(struct.pack('!BBHB', 0x90, 4, msg_id, 0) + b'\x00')
+        else:
+            await websocket.send(struct.pack('!BBH', 0x90, 3, msg_id) + b'\x00')
 
     async def handle_unsubscribe(self, websocket, message):
-        msg_id, = struct.unpack('!H', message[2:4])
-        payload = message[4:]
+        remaining_length, index = self.decode_remaining_length(message, 1)
+        msg_id, = struct.unpack('!H', message[index:index+2])
+        index += 2
+        is_v5 = self.protocol_levels.get(websocket, 4) >= 5
+        if is_v5:
+            props, index = self.parse_properties(message, index)
+        payload = message[index:]
         topics = self.parse_unsubscribe_topics(payload)
         for topic in topics:
             if topic in self.subscribers and websocket in self.subscribers[topic]:
                 self.subscribers[topic].remove(websocket)
                 if not self.subscribers[topic]:
                     del self.subscribers[topic]
-        await websocket.send(struct.pack('!BBH', 0xB0, 2, msg_id) + b'\x00')
+            conflater = self.conflaters.pop((websocket, topic), None)
+            if conflater is not None:
+                conflater.cancel()
+            await self.update_interest(topic)
+        if is_v5:
+            await websocket.send(struct.pack('!BBHB', 0xB0, 4, msg_id, 0) + b'\x00')
+        else:
+            await websocket.send(struct.pack('!BBH', 0xB0, 2, msg_id) + b'\x00')
     
-    async def handle_publish(self, message):
-        data = bytearray(message)
+    async def handle_publish(self, message, source=None):
+        '''
+        Forward a PUBLISH to the subscribers of its topic
+        source: the websocket or BridgeLink the message came from
+        The message is forwarded as is when it has no topic alias or bridge path, otherwise only the header is rebuilt:
+        a memoryview keeps the payload uncopied until the message is joined (one copy per encoded variant)
+        '''
+        data = memoryview(message)
 
         index = 1
         multiplier = 1
@@ -119,12 +406,16 @@ class WebSocketMQServer:
         
         topic_length = struct.unpack('!H', data[index:index+2])[0]
         index += 2
-        topic = data[index:index+topic_length].decode()
+        topic_start = index
         index += topic_length
         properties_length = data[index]
         index += 1
         props = {}
+        properties = b''  # Properties without the bridge path and the topic alias
+        path = []  # Node ids of the servers the message went through
+        topic_alias = None
         while properties_length > 0:
+            prop_start = index
             prop_id = data[index]
             index += 1
             properties_length -= 1
@@ -136,21 +427,165 @@ class WebSocketMQServer:
                 content_type_length = data[index]
                 index += 1
                 properties_length -= 1
-                props['content_type'] = data[index:index+content_type_length].decode()
+                props['content_type'] = bytes(data[index:index+content_type_length]).decode()
                 index += content_type_length
                 properties_length -= content_type_length
+            elif prop_id == 38:  # User Property
+                key_length = data[index]
+                key = bytes(data[index+1:index+1+key_length]).decode()
+                index += 1 + key_length
+                value_length = data[index]
+                value = bytes(data[index+1:index+1+value_length]).decode()
+                index += 1 + value_length
+                properties_length -= 2 + key_length + value_length
+                if key == 'path':
+                    path = value.split(',')
+                    continue
+            elif prop_id == 35:  # Topic Alias
+                topic_alias, = struct.unpack('!H', data[index:index+2])
+                index += 2
+                properties_length -= 2
+                continue
+            properties += bytes(data[prop_start:index])
         payload = data[index:]
 
+        aliases = self.topic_aliases.get(source)
+        if topic_alias is None:
+            topic = bytes(data[topic_start:topic_start+topic_length]).decode()
+        elif topic_length == 0:  # Route on the alias alone
+            topic = aliases.get(topic_alias) if aliases is not None else None
+            if topic is None:
+                logging.warning(f'Unknown topic alias {topic_alias}')
+                return
+        else:
+            topic = bytes(data[topic_start:topic_start+topic_length]).decode()
+            if aliases is not None and 0 < topic_alias <= self.topic_alias_maximum:
+                aliases[topic_alias] = topic
+
+        if self.node_id in path:
+            return  # Loop
+        link_message = None
+        messages = {}  # key: (alias, with topic), value: message, shared between subscribers
+        if not path and topic_alias is None:
+            messages[(None, False)] = message  # Forward as is, otherwise the path and the alias are stripped when needed
+
+        if props.get('content_type') == 'video/encoded':
+            self.video_topics.add(topic)  # Inter-frames can't be dropped
+
         if topic in self.subscribers:
-            for subscriber in self.subscribers[topic]:
-                await subscriber.send(message)
+            for subscriber in list(self.subscribers[topic]):
+                if isinstance(subscriber, BridgeLink):
+                    if subscriber is source or subscriber.peer_id in path:
+                        continue
+                    if link_message is None:
+                        link_properties = properties + self.encode_user_property('path', ','.join(path + [self.node_id]))
+                        link_message = self.encode_publish(data[0], topic, link_properties, payload)
+                    await subscriber.send(link_message)
+                    continue
+                conflater = self.conflaters.get((subscriber, topic))
+                if conflater is None:
+                    await subscriber.send(self.alias_message(subscriber, topic, data[0], properties, payload, messages))
+                elif topic in self.video_topics:
+                    await conflater.drain()
+                    await subscriber.send(self.alias_message(subscriber, topic, data[0], properties, payload, messages))
+                else:
+                    await conflater.send(self.alias_message(None, topic, data[0], properties, payload, messages))
                 logging.debug(f'Sent message to subscriber: {topic}, props: {props}')
+
+    def alias_message(self, subscriber, topic, fixed_header, properties, payload, cache):
+        '''
+        Return the message to send to subscriber, using a topic alias if the subscriber accepts them
+        (subscriber None for the message without alias)
+        cache: messages already encoded for this publish, shared between subscribers
+        '''
+        aliases = self.subscriber_aliases.get(subscriber)
+        alias = None
+        with_topic = False
+        if aliases is not None:
+            alias = aliases.get(topic)
+            if alias is None and len(aliases) < self.subscriber_alias_maximums[subscriber]:
+                alias = aliases[topic] = len(aliases) + 1
+                with_topic = True
+        key = (alias, with_topic)
+        if key not in cache:
+            if alias is None:
+                cache[key] = self.encode_publish(fixed_header, topic, properties, payload)
+            else:
+                alias_properties = properties + struct.pack('!BH', 35, alias)  # Topic Alias
+                cache[key] = self.encode_publish(fixed_header, topic if with_topic else '', alias_properties, payload)
+        return cache[key]
+
+    def encode_publish(self, fixed_header, topic, properties, payload):
+        topic = topic.encode()
+        remaining_length = 2 + len(topic) + 1 + len(properties) + len(payload)
+        header = struct.pack('!B', fixed_header) + self.encode_remaining_length(remaining_length) + struct.pack('!H', len(topic)) + topic + struct.pack('!B', len(properties)) + properties
+        return b''.join((header, payload))
+
+    def encode_user_property(self, key, value):
+        return struct.pack('!BB', 38, len(key)) + key.encode() + struct.pack('!B', len(value)) + value.encode()  # User Property
+
+    def encode_remaining_length(self, length):
+        encoded = b''
+        while True:
+            digit = length % 128
+            length = length // 128
+            # if there are more digits to encode, set the top bit of this digit
+            if length > 0:
+                digit = digit | 0x80
+            encoded += struct.pack('!B', digit)
+            if length <= 0:
+                break
+        return encoded
+
+    def decode_remaining_length(self, data, index):
+        '''
+        Decode the remaining length starting at index, return it and the index after it
+        '''
+        multiplier = 1
+        remaining_length = 0
+        while True:
+            digit = data[index]
+            index += 1
+            remaining_length += (digit & 127) * multiplier
+            multiplier *= 128
+            if (digit & 128) == 0:
+                break
+        return remaining_length, index
     
     async def handle_pingreq(self, websocket):
         pingresp_message = struct.pack('!BB', 0xD0, 0x00)
         await websocket.send(pingresp_message)
         logging.debug('Sent PINGRESP')
 
+    def parse_properties(self, data, index):
+        '''
+        Parse the properties of CONNECT, CONNACK, SUBSCRIBE and UNSUBSCRIBE (protocol level 5)
+        Return the properties and the index after them
+        '''
+        properties_length = data[index]
+        index += 1
+        end = index + properties_length
+        props = {}
+        while index < end:
+            prop_id = data[index]
+            index += 1
+            if prop_id == 34:  # Topic Alias Maximum
+                props['topic_alias_maximum'], = struct.unpack('!H', data[index:index+2])
+                index += 2
+            elif prop_id == 38:  # User Property
+                key_length = data[index]
+                index += 1
+                key = bytes(data[index:index+key_length]).decode()
+                index += key_length
+                value_length = data[index]
+                index += 1
+                value = bytes(data[index:index+value_length]).decode()
+                index += value_length
+                props.setdefault('user_properties', {})[key] = value
+            else:
+                break  # Unknown property, skip the rest
+        return props, end
+
     def parse_subscribe_topics(self, payload):
         topics = []
         i = 0
@@ -176,10 +611,13 @@ class WebSocketMQServer:
         return topics
 
 def run():
+    '''
+    Usage: wsmq [port] [peer_url ...]
+    '''
     port = 6789
     if len(sys.argv) > 1:
         port = int(sys.argv[1])
-    server = WebSocketMQServer(host='localhost', port=port)
+    server = WebSocketMQServer(host='localhost', port=port, peers=sys.argv[2:])
     server.start()
 
 def start():
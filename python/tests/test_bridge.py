@@ -0,0 +1,28 @@
+import threading
+from wsmq import WebSocketMQServer, WebSocketMQClient
+
+if __name__ == '__main__':
+    # Chain of brokers: site_a <-> hub <-> site_b
+    # Same as running `wsmq 6790`, `wsmq 6791 ws://localhost:6790` and `wsmq 6792 ws://localhost:6790`
+    WebSocketMQServer(port=6790, node_id='hub').start(daemon=True)
+    WebSocketMQServer(port=6791, peers=['ws://localhost:6790'], node_id='site_a').start(daemon=True)
+    WebSocketMQServer(port=6792, peers=['ws://localhost:6790'], node_id='site_b').start(daemon=True)
+    threading.Event().wait(1)
+
+    subscriber = WebSocketMQClient(url='ws://localhost:6792')
+    subscriber.connect(daemon=True)
+    subscriber.wait_ready()
+    subscriber.subscribe(
+        'site_a/telemetry',
+        lambda topic, payload, props: print(f'Receive {topic}: {payload}, props: {props}')
+    )
+    threading.Event().wait(0.5)  # Let the subscription propagate to site_a
+
+    publisher = WebSocketMQClient(url='ws://localhost:6791')
+    publisher.connect(daemon=True)
+    publisher.wait_ready()
+    for i in range(10):
+        publisher.publish('site_a/telemetry', f'Hello from site_a {i}', content_type='text/plain')
+    threading.Event().wait(1)
+    subscriber.disconnect()
+    publisher.disconnect()
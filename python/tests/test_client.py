@@ -4,8 +4,7 @@ from wsmq import WebSocketMQClient
 if __name__ == '__main__':
     client = WebSocketMQClient(url='ws://localhost:6789')
     client.connect()
-    
-    threading.Event().wait(1)
+    client.wait_ready()
     
     client.subscribe(
         'test/topic',
@@ -0,0 +1,33 @@
+import time
+import numpy as np
+from wsmq import WebSocketMQServer, ImageStream
+
+if __name__ == '__main__':
+    WebSocketMQServer(port=6795).start(daemon=True)
+    time.sleep(0.5)
+
+    topic = 'video/keyframe_request'
+    width, height = 320, 240
+    publisher = ImageStream(url='ws://localhost:6795')
+    publisher.publish(topic, {'width': width, 'height': height, 'frame_rate': 30, 'gop_size': 100000})  # Before start, queued until connected
+    publisher.start()
+
+    frames = []
+    for i in range(150):  # 5 seconds at 30 FPS
+        if i == 60:  # Late joiner, 2 seconds after the only natural keyframe
+            joined_at = time.time()
+            subscriber = ImageStream(url='ws://localhost:6795')
+            subscriber.start()
+            subscriber.subscribe(topic, image_format='ndarray', on_receive=lambda topic, img: frames.append(time.time()))
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        frame[:, :, 1] = (np.arange(width) + 4 * i) % 256  # Moving gradient
+        publisher.add_image(topic, frame)
+        time.sleep(1 / 30)  # Simulate 30 FPS
+    time.sleep(0.5)
+
+    if frames:
+        print(f'Late joiner got its first frame after {frames[0] - joined_at:.2f} s and {len(frames)} frames in total')
+    else:
+        print('Late joiner got no frame')
+    subscriber.stop()
+    publisher.stop()
@@ -0,0 +1,31 @@
+import threading
+from wsmq import WebSocketMQServer, WebSocketMQClient
+
+if __name__ == '__main__':
+    WebSocketMQServer(port=6793).start(daemon=True)
+    threading.Event().wait(0.5)
+
+    received = {'all': 0, 'limited': 0}
+    subscriber = WebSocketMQClient(url='ws://localhost:6793')
+    subscriber.protocol_level = 5  # Needed for max_rate
+    subscriber.connect(daemon=True)
+    subscriber.wait_ready()
+    subscriber.subscribe('test/all', lambda topic, payload, props: received.update(all=received['all'] + 1))
+    subscriber.subscribe(
+        'test/limited',
+        lambda topic, payload, props: print(f'Receive {topic}: {payload}') or received.update(limited=received['limited'] + 1),
+        max_rate=5
+    )
+    threading.Event().wait(0.5)
+
+    publisher = WebSocketMQClient(url='ws://localhost:6793')
+    publisher.connect(daemon=True)
+    publisher.wait_ready()
+    for i in range(100):  # 100 messages in about 2 seconds
+        publisher.publish('test/all', str(i))
+        publisher.publish('test/limited', str(i))
+        threading.Event().wait(0.02)
+    threading.Event().wait(0.5)
+    print(f"Received {received['all']} of 100 messages without max_rate, {received['limited']} with max_rate=5 (the last one is 99)")
+    subscriber.disconnect()
+    publisher.disconnect()
@@ -0,0 +1,41 @@
+import time
+import numpy as np
+from wsmq import WebSocketMQServer, ImageStream
+
+if __name__ == '__main__':
+    WebSocketMQServer(port=6796).start(daemon=True)
+    time.sleep(0.5)
+
+    topic = 'video/static_scene'
+    width, height = 320, 240
+    publisher = ImageStream(url='ws://localhost:6796')
+    publisher.change_threshold = 4  # Skip images where no 4x4 area changed by more than 4 (out of 255)
+    publisher.max_skip_interval = 1  # But queue one image per second anyway
+    publisher.start()
+    subscriber = ImageStream(url='ws://localhost:6796')
+    subscriber.start()
+    frames = []
+    subscriber.subscribe(topic, image_format='ndarray', on_receive=lambda topic, img: frames.append(img))
+    time.sleep(0.5)
+    publisher.publish(topic, {'width': width, 'height': height, 'frame_rate': 30})
+
+    scene = np.zeros((height, width, 3), dtype=np.uint8)
+    scene[:, :, 1] = np.arange(width) % 256
+    for i in range(90):  # 3 seconds of a static scene with sensor noise
+        noise = np.random.randint(-2, 3, scene.shape)
+        publisher.add_image(topic, np.clip(scene + noise, 0, 255).astype(np.uint8), image_format='opencv')
+        time.sleep(1 / 30)  # Simulate 30 FPS
+    time.sleep(0.5)
+    print(f'Static scene: {len(frames)} of 90 images sent, {90 - len(frames)} skipped')
+
+    frames.clear()
+    for i in range(30):  # 1 second with a 3 px wide moving stripe
+        image = scene.copy()
+        image[:, 2 * i:2 * i + 3] = 255
+        publisher.add_image(topic, image, image_format='opencv')
+        time.sleep(1 / 30)
+    time.sleep(0.5)
+    print(f'Moving stripe: {len(frames)} of 30 images sent')
+    print(f'Subscriber still presents the last frame: {subscriber.get_image(topic, "ndarray").shape}')
+    subscriber.stop()
+    publisher.stop()
@@ -0,0 +1,25 @@
+import threading
+from wsmq import WebSocketMQServer, WebSocketMQClient
+
+if __name__ == '__main__':
+    WebSocketMQServer(port=6794).start(daemon=True)
+    threading.Event().wait(0.5)
+
+    topic = 'site/camera/front-door/telemetry/temperature'
+    subscriber = WebSocketMQClient(url='ws://localhost:6794')
+    subscriber.protocol_level = 5  # Needed for topic aliases
+    subscriber.connect(daemon=True)
+    subscriber.wait_ready()
+    subscriber.subscribe(topic, lambda topic, payload, props: print(f'Receive {topic}: {payload}'))
+    threading.Event().wait(0.5)
+
+    publisher = WebSocketMQClient(url='ws://localhost:6794')
+    publisher.protocol_level = 5
+    publisher.connect(daemon=True)
+    publisher.wait_ready()
+    for i in range(5):
+        publisher.publish(topic, str(i))  # Only the first message carries the topic, the others a 2-byte alias
+    threading.Event().wait(0.5)
+    print(f'Publisher aliases: {publisher.publish_aliases}, subscriber aliases: {subscriber.topic_aliases}')
+    subscriber.disconnect()
+    publisher.disconnect()